@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 import argparse
-import subprocess
+import asyncio
+import atexit
 import sys
-import datetime
+import os
+import random
+import re
 import shutil
+import threading
+from asyncio import create_subprocess_exec as _create_subprocess_exec
+from asyncio.subprocess import DEVNULL as _DEVNULL, PIPE as _PIPE, STDOUT as _STDOUT
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from shutil import copy as _copy
+from time import localtime as _localtime, monotonic as _monotonic, strftime as _strftime, time_ns as _time_ns
 
 # Log file path
 log_file_path = "setup.log"
@@ -13,127 +22,305 @@ log_file_path = "setup.log"
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Setup script for Raspberry Pi access point and Pi-hole, with added backup and debug features.")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode for more verbose output.")
+    parser.add_argument("--full-upgrade", action="store_true", help="Also upgrade all installed packages (slow; not required for the access point).")
     return parser.parse_args()
 
 args = parse_arguments()
 debug_mode = args.debug
+full_upgrade = args.full_upgrade
 
-def log_message(message, level="INFO"):
+# Keep the log open for the whole run; entries are buffered in memory and written in batches
+LOG_FH = open(log_file_path, "a", buffering=1)
+LOG_FLUSH_ENTRIES = 32
+LOG_FLUSH_BYTES = 8 * 1024
+LOG_FLUSH_INTERVAL = 1.0  # seconds
+_LOG_BUF = []
+_LOG_BUF_BYTES = 0
+_LOG_LAST_FLUSH = _monotonic()
+# Guards the buffer; backup_file may log from a worker thread
+_LOG_LOCK = threading.RLock()
+
+def flush_log():
+    """Write any buffered log entries to the log file in a single write."""
+    global _LOG_BUF_BYTES, _LOG_LAST_FLUSH
+    with _LOG_LOCK:
+        if _LOG_BUF:
+            LOG_FH.write("".join(_LOG_BUF))
+            _LOG_BUF.clear()
+            _LOG_BUF_BYTES = 0
+        _LOG_LAST_FLUSH = _monotonic()
+
+def _close_log():
+    flush_log()
+    LOG_FH.close()
+
+# Runs on normal exit and on every sys.exit(1), so nothing buffered is lost
+atexit.register(_close_log)
+
+def _write_log(text, flush=False):
+    """Append raw text to the log buffer, flushing it once a threshold is reached."""
+    global _LOG_BUF_BYTES
+    with _LOG_LOCK:
+        _LOG_BUF.append(text)
+        _LOG_BUF_BYTES += len(text)
+        if (flush or len(_LOG_BUF) >= LOG_FLUSH_ENTRIES or _LOG_BUF_BYTES >= LOG_FLUSH_BYTES
+                or _monotonic() - _LOG_LAST_FLUSH >= LOG_FLUSH_INTERVAL):
+            flush_log()
+
+def log_message(message, level="INFO", console=True):
     """Log a message to the setup.log file with a timestamp, and optionally print to console."""
-    log_entry = f"{datetime.datetime.now()}: [{level}] {message}\n"
-    with open(log_file_path, "a") as log_file:
-        log_file.write(log_entry)
-    if level in ["INFO", "ERROR"] or debug_mode:
+    now_ns = _time_ns()
+    timestamp = _strftime("%Y-%m-%d %H:%M:%S", _localtime(now_ns // 1_000_000_000))
+    log_entry = f"{timestamp}.{now_ns % 1_000_000_000 // 1000:06d}: [{level}] {message}\n"
+    _write_log(log_entry, flush=level == "ERROR")
+    if console and (level in ["INFO", "ERROR"] or debug_mode):
         print(message)
 
-def run_command(command, success_message="", failure_message=""):
-    """Run a shell command and log its output, with error handling."""
+async def run_command(argv, success_message="", failure_message=""):
+    """Run a command (argument list, no shell) and log its output, with error handling."""
+    command = " ".join(argv)
+    try:
+        proc = await _create_subprocess_exec(*argv, stdout=_PIPE, stderr=_STDOUT)
+        out, _ = await proc.communicate()
+    except OSError as e:
+        log_message(failure_message or f"Error executing {command}: {e}", level="ERROR")
+        return False
+    output = out.decode(errors="replace")
+    if proc.returncode != 0:
+        log_message(failure_message or f"Error executing {command}: {output}", level="ERROR")
+        return False
+    log_message(success_message or f"Successfully executed: {command}")
+    if debug_mode:
+        log_message(f"Output: {output}")
+    return True
+
+async def run_script(script, success_message="", failure_message=""):
+    """Run several shell steps in a single bash invocation, logging one combined result."""
+    return await run_command(["bash", "-c", script], success_message, failure_message)
+
+async def run_command_streaming(argv, success_message="", failure_message="", env=None):
+    """Run a long, chatty command, writing its output to the log line by line instead of holding it in memory."""
+    command = " ".join(argv)
+    log_message(f"Running: {command}", level="DEBUG")
     try:
-        output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT, text=True)
-        log_message(success_message or f"Successfully executed: {command}")
+        proc = await _create_subprocess_exec(*argv, stdout=_PIPE, stderr=_STDOUT, env=env)
+    except OSError as e:
+        log_message(failure_message or f"Error executing {command}: {e}", level="ERROR")
+        return False
+    async for raw_line in proc.stdout:
+        line = raw_line.decode(errors="replace")
+        _write_log(line)
         if debug_mode:
-            log_message(f"Output: {output}")
-    except subprocess.CalledProcessError as e:
-        log_message(failure_message or f"Error executing {command}: {e.output}", level="ERROR")
+            print(line, end="")
+    returncode = await proc.wait()
+    if returncode != 0:
+        log_message(failure_message or f"Error executing {command}: exit status {returncode}", level="ERROR")
         return False
+    log_message(success_message or f"Successfully executed: {command}")
     return True
 
-def install_iptables():
+async def package_installed(package):
+    """Return True if dpkg reports the package as installed."""
     try:
-        run_command("sudo apt-get install iptables-persistent")
-        run_command("sudo iptables -t nat -A POSTROUTING -o eth0 -j MASQUERADE")
-        run_command("sudo sh -c 'iptables-save > /etc/iptables.ipv4.nat'")
-        run_command("sudo sed -i '/net.ipv4.ip_forward=1/s/^#//g' /etc/sysctl.conf")
-        run_command("sudo sysctl -w net.ipv4.ip_forward=1")
-    except Exception as e:
-        log_message(f"Failed to install iptables-persistent: {e}", level="ERROR")
-        sys.exit(1)
-        
-        
-def run_command(command, success_message="", failure_message=""):
-    """Run a shell command and log its output, with error handling."""
+        proc = await _create_subprocess_exec("dpkg-query", "-W", "-f=${Status}", package, stdout=_PIPE, stderr=_DEVNULL)
+        out, _ = await proc.communicate()
+    except OSError:
+        return False
+    return proc.returncode == 0 and out.decode().endswith("install ok installed")
+
+def write_file_atomic(path, content):
+    """Write content to path via a temporary file and rename, keeping the original file mode."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
     try:
-        output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT, text=True)
-        log_message(success_message or f"Successfully executed: {command}")
-        if debug_mode:
-            log_message(f"Output: {output}")
-    except subprocess.CalledProcessError as e:
-        log_message(failure_message or f"Error executing {command}: {e.output}", level="ERROR")
+        shutil.copymode(path, tmp_path)
+    except FileNotFoundError:
+        pass
+    os.replace(tmp_path, path)
+
+def ensure_line(path, pattern, replacement):
+    """Apply a multi-line regex substitution to a file, writing only if something changed.
+
+    Returns True if the file was rewritten.
+    """
+    with open(path) as f:
+        content = f.read()
+    updated = re.sub(pattern, replacement, content, flags=re.MULTILINE)
+    if updated == content:
+        return False
+    write_file_atomic(path, updated)
+    return True
+
+SYSCTL_CONF = "/etc/sysctl.conf"
+# Commented-out forwarding line in sysctl.conf; ensure_line uncomments it
+IP_FORWARD_COMMENTED = r"^#(.*net\.ipv4\.ip_forward=1.*)$"
+
+# Time of the last successful connectivity check, so back-to-back checks can skip the probe
+CONNECTIVITY_CACHE_TTL = 30  # seconds
+_LAST_OK_TS = 0.0
+
+async def _internet_ok(timeout=2.0):
+    """Return True if a TCP connection to Google DNS (8.8.8.8:53) opens within timeout seconds."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection("8.8.8.8", 53), timeout)
+    except (OSError, asyncio.TimeoutError):
         return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
     return True
 
-def check_internet_connection(retry_attempts=1, failure_callbacks=[]):
-    """Check for an active internet connection before proceeding."""
+async def check_internet_connection(retry_attempts=1, failure_callbacks=(), force=False):
+    """Check for an active internet connection before proceeding.
+
+    A success within the last CONNECTIVITY_CACHE_TTL seconds is reused unless force is set.
+    On failure, the async failure_callbacks are run concurrently.
+    """
+    global _LAST_OK_TS
+    if not force and _LAST_OK_TS and _monotonic() - _LAST_OK_TS < CONNECTIVITY_CACHE_TTL:
+        log_message("Internet connection was verified recently; skipping check.")
+        return True
     log_message("Checking internet connection...")
-    for _ in range(retry_attempts):
-        if run_command("ping -c 4 8.8.8.8", "Internet connection is active.", "No internet connection detected."):
+    delay = 0.5
+    for attempt in range(retry_attempts):
+        final_attempt = attempt == retry_attempts - 1
+        # Short probes first; the last attempt waits longer before giving up
+        if await _internet_ok(timeout=5.0 if final_attempt else 2.0):
+            log_message("Internet connection is active.")
+            _LAST_OK_TS = _monotonic()
             return True
+        log_message("No internet connection detected.", level="ERROR")
+        if not final_attempt:
+            await asyncio.sleep(delay + random.uniform(0, 0.25))
+            delay = min(delay * 2, 8)
     log_message("Internet connection check failed after retries.")
-    for callback in failure_callbacks:
-        callback()
+    await asyncio.gather(*(callback() for callback in failure_callbacks))
     return False
 
-def diagnose_connection_issue():
+async def diagnose_connection_issue():
     """Diagnose internet connection issue."""
     log_message("Diagnosing internet connection issue...")
-    run_command("ip addr show", "Network interfaces:", "Failed to retrieve network interfaces.")
+    await run_command(["ip", "addr", "show"], "Network interfaces:", "Failed to retrieve network interfaces.")
 
-def update_system_and_install_packages():
-    """Update the system and install required packages for the access point."""
-    log_message("Updating system packages. This might take a while...")
-    if not run_command("apt-get update && apt-get upgrade -y", "System updated successfully.", "Failed to update the system."):
+async def _apt_install(packages):
+    """Refresh package lists once, optionally upgrade, and install the given packages in a single apt run."""
+    apt_env = {**os.environ, "DEBIAN_FRONTEND": "noninteractive"}
+    log_message("Updating package lists...")
+    if not await run_command_streaming(["apt-get", "update", "-qq"], "Package lists updated.", "Failed to update package lists.", env=apt_env):
         sys.exit(1)
+    if full_upgrade:
+        log_message("Upgrading system packages. This might take a while...")
+        if not await run_command_streaming(["apt-get", "upgrade", "-y"], "System updated successfully.", "Failed to update the system.", env=apt_env):
+            sys.exit(1)
+    if not packages:
+        return
 
-    log_message("Installing hostapd and dnsmasq...")
-    if not run_command("apt-get install -y hostapd dnsmasq", "hostapd and dnsmasq installed successfully.", "Failed to install hostapd and dnsmasq."):
+    names = ", ".join(packages)
+    log_message(f"Installing {names}...")
+    if not await run_command_streaming(
+        ["apt-get", "install", "-y", "--no-install-recommends", *packages],
+        f"{names} installed successfully.",
+        f"Failed to install {names}.",
+        env=apt_env,
+    ):
         sys.exit(1)
 
+async def update_system_and_install_packages():
+    """Update the system and install required packages for the access point."""
+    packages = ["hostapd", "dnsmasq", "iptables-persistent"]
+    installed = await asyncio.gather(*(package_installed(p) for p in packages))
+    missing = [p for p, ok in zip(packages, installed) if not ok]
+    if missing or full_upgrade:
+        await _apt_install(missing)
+    else:
+        log_message("hostapd, dnsmasq and iptables-persistent are already installed; skipping apt.")
+
     # Disable services to prevent them from starting automatically until they are fully configured
-    run_command("systemctl stop hostapd", "hostapd service stopped.", "Failed to stop hostapd service.")
-    run_command("systemctl stop dnsmasq", "dnsmasq service stopped.", "Failed to stop dnsmasq service.")
-    run_command("systemctl disable hostapd", "hostapd service disabled.", "Failed to disable hostapd service.")
-    run_command("systemctl disable dnsmasq", "dnsmasq service disabled.", "Failed to disable dnsmasq service.")
+    await run_command(
+        ["systemctl", "disable", "--now", "hostapd", "dnsmasq"],
+        "hostapd and dnsmasq services stopped and disabled.",
+        "Failed to stop and disable hostapd and dnsmasq services.",
+    )
 
 
-def ensure_ipv4_forwarding():
+async def ensure_ipv4_forwarding():
     """Enable IPv4 packet forwarding to allow the Pi to route traffic."""
     log_message("Enabling IPv4 forwarding...")
-    if not run_command("sysctl -w net.ipv4.ip_forward=1", "IPv4 forwarding enabled.", "Failed to enable IPv4 forwarding."):
+    try:
+        forwarding_on = Path("/proc/sys/net/ipv4/ip_forward").read_text().strip() == "1"
+    except OSError:
+        forwarding_on = False
+    if forwarding_on:
+        log_message("IPv4 forwarding already enabled.")
+    elif not await run_command(["sysctl", "-w", "net.ipv4.ip_forward=1"], "IPv4 forwarding enabled.", "Failed to enable IPv4 forwarding."):
         sys.exit(1)
-    run_command("sed -i '/net.ipv4.ip_forward=1/s/^#//g' /etc/sysctl.conf", "Made IPv4 forwarding persistent.")
+    try:
+        if ensure_line(SYSCTL_CONF, IP_FORWARD_COMMENTED, r"\1"):
+            log_message("Made IPv4 forwarding persistent.")
+    except OSError as e:
+        log_message(f"Failed to make IPv4 forwarding persistent: {e}", level="ERROR")
 
-def setup_nat_routing():
+async def setup_nat_routing():
     """Set up NAT routing to allow connected devices to access the internet through the Pi."""
     log_message("Configuring NAT routing...")
-    if not run_command("iptables -t nat -A POSTROUTING -o eth0 -j MASQUERADE", "NAT routing configured.", "Failed to configure NAT routing."):
+    if not await run_script(
+        "iptables -t nat -A POSTROUTING -o eth0 -j MASQUERADE && iptables-save > /etc/iptables.ipv4.nat",
+        "NAT routing configured and iptables rule saved.",
+        "Failed to configure NAT routing.",
+    ):
         sys.exit(1)
-    run_command("sh -c 'iptables-save > /etc/iptables.ipv4.nat'", "Saved iptables rule.")
-
-def backup_file(file_path, backup_dir="/backup"):
-    """Backup a specified configuration file."""
-    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    backup_dir_path = Path(backup_dir) / timestamp
-    backup_file_path = backup_dir_path / Path(file_path).name
-    backup_dir_path.mkdir(parents=True, exist_ok=True)
+
+# Backup directories already created by this process
+_BACKUP_DIRS_READY = set()
+
+def backup_file(file_path, backup_dir="/backup", console=True):
+    """Backup a specified configuration file as <backup_dir>/<name>.<timestamp>.
+
+    Returns False if the backup failed. Pass console=False to log to the file only.
+    """
+    if not Path(file_path).exists():
+        log_message(f"{file_path} does not exist yet; nothing to back up.", console=console)
+        return True
+    timestamp = _strftime("%Y%m%d-%H%M%S")
+    backup_file_path = Path(backup_dir) / f"{Path(file_path).name}.{timestamp}"
     try:
-        shutil.copy(file_path, backup_file_path)
-        log_message(f"Backed up {file_path} to {backup_file_path}")
+        if backup_dir not in _BACKUP_DIRS_READY:
+            Path(backup_dir).mkdir(parents=True, exist_ok=True)
+            _BACKUP_DIRS_READY.add(backup_dir)
+        # Never overwrite an earlier backup taken within the same second
+        suffix = 1
+        while backup_file_path.exists():
+            backup_file_path = Path(backup_dir) / f"{Path(file_path).name}.{timestamp}-{suffix}"
+            suffix += 1
+        _copy(file_path, backup_file_path)
+        log_message(f"Backed up {file_path} to {backup_file_path}", console=console)
     except Exception as e:
-        log_message(f"Failed to backup {file_path}: {e}", level="ERROR")
-        sys.exit(1)
+        log_message(f"Failed to backup {file_path}: {e}", level="ERROR", console=console)
+        return False
+    return True
+
+# WPA2 passphrases are 8-63 characters; 2.4 GHz channels 1-11 are valid everywhere
+_PW_RE = re.compile(r"^.{8,63}$")
+_CHAN_RE = re.compile(r"^(?:[1-9]|1[0-1])$")
 
 def prompt_for_ap_config():
     """Prompt the user for access point configuration details, such as SSID and password."""
     print("Please enter your access point configuration details.")
     ssid = input("SSID Name: ")
-    password = input("Password (min 8 characters): ")
-    while len(password) < 8:
-        print("Password must be at least 8 characters.")
+    password = input("Password (8-63 characters): ")
+    while not _PW_RE.match(password):
+        print("Password must be between 8 and 63 characters.")
         password = input("Password: ")
-    channel = input("Channel (1-11): ")
+    channel = input("Channel (1-11): ").strip()
+    while not _CHAN_RE.match(channel):
+        print("Channel must be a number from 1 to 11.")
+        channel = input("Channel (1-11): ").strip()
     return ssid, password, channel
 
-def configure_hostapd(ssid, password, channel):
+async def configure_hostapd(ssid, password, channel):
     """Configure the hostapd service with the user's specified settings."""
     log_message("Configuring hostapd...")
     hostapd_config = hostapd_config = (
@@ -148,64 +335,73 @@ def configure_hostapd(ssid, password, channel):
     f"rsn_pairwise=CCMP"
 )
     try:
-        with open("/etc/hostapd/hostapd.conf", "w") as f:
-            f.write(hostapd_config)
+        try:
+            existing = Path("/etc/hostapd/hostapd.conf").read_text()
+        except FileNotFoundError:
+            existing = ""
+        if existing == hostapd_config:
+            log_message("hostapd config unchanged; skipping restart.")
+            return
+        write_file_atomic("/etc/hostapd/hostapd.conf", hostapd_config)
         log_message("Hostapd configured successfully.")
-        run_command("systemctl restart hostapd", "Restarted hostapd.", "Failed to restart hostapd.")
+        await run_command(["systemctl", "restart", "hostapd"], "Restarted hostapd.", "Failed to restart hostapd.")
     except Exception as e:
         log_message(f"Failed to configure hostapd: {e}", level="ERROR")
         sys.exit(1)
         
-def enable_and_start_services():
+async def enable_and_start_services():
     """Enable and start required services for the access point."""
     log_message("Enabling and starting hostapd and dnsmasq services...")
-    services = ["hostapd", "dnsmasq"]
-    for service in services:
-        if not run_command(f"systemctl enable {service}", f"{service} service enabled.", f"Failed to enable {service} service."):
-            sys.exit(1)
-        if not run_command(f"systemctl start {service}", f"{service} service started.", f"Failed to start {service} service."):
-            sys.exit(1)
+    if not await run_command(
+        ["systemctl", "enable", "--now", "hostapd", "dnsmasq"],
+        "hostapd and dnsmasq services enabled and started.",
+        "Failed to enable and start hostapd and dnsmasq services.",
+    ):
+        sys.exit(1)
 
-def prompt_for_reboot():
+async def prompt_for_reboot():
     """Prompt the user for a system reboot to apply changes."""
     reboot = input("Setup is complete. Would you like to reboot now? (yes/no): ")
     if reboot.lower() in ['yes', 'y']:
         log_message("Rebooting the system to apply changes...")
-        run_command("reboot", "System is rebooting...", "Failed to initiate reboot.")
+        flush_log()
+        await run_command(["reboot"], "System is rebooting...", "Failed to initiate reboot.")
     else:
         log_message("Reboot skipped. Please manually reboot the system later to apply changes.")
 
-def main():
+async def main():
     global debug_mode
     log_message("Starting Raspberry Pi setup...")
-    install_iptables()
-    check_internet_connection(retry_attempts=1, failure_callbacks=[diagnose_connection_issue])
-    update_system_and_install_packages()
-    ensure_ipv4_forwarding()
-    setup_nat_routing()
+    await check_internet_connection(retry_attempts=1, failure_callbacks=(diagnose_connection_issue,))
+    await update_system_and_install_packages()
+    await ensure_ipv4_forwarding()
+    await setup_nat_routing()
     
    
     
-    # Configure the access point
-    ssid, password, channel = prompt_for_ap_config()
-    configure_hostapd(ssid, password, channel)
-    
-     # Backup original hostapd configuration file
-    #backup_file("/etc/hostapd/hostapd.conf")
+    # Configure the access point, backing up the original hostapd configuration while the user types
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The worker only writes to the log file so nothing is printed over the prompts
+        backup_future = executor.submit(backup_file, "/etc/hostapd/hostapd.conf", console=False)
+        ssid, password, channel = prompt_for_ap_config()
+        if not backup_future.result():
+            log_message(f"Failed to back up /etc/hostapd/hostapd.conf; see {log_file_path} for details.", level="ERROR")
+            sys.exit(1)
+    await configure_hostapd(ssid, password, channel)
     
     #enable services and reboot pi
-    enable_and_start_services()
+    await enable_and_start_services()
     
     
     log_message("Setup process almost complete. Rechecking internet connection...")
-    # Recheck internet connection with retry and failure callbacks
-    if not check_internet_connection(retry_attempts=3, failure_callbacks=[diagnose_connection_issue]):
+    # Recheck internet connection with retry and failure callbacks; the network changed, so bypass the cache
+    if not await check_internet_connection(retry_attempts=3, failure_callbacks=(diagnose_connection_issue,), force=True):
         log_message("Final internet connection check failed. See previous logs for diagnostic info.")
         
-    prompt_for_reboot()
+    await prompt_for_reboot()
     
     
     log_message("Raspberry Pi setup complete.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())